@@ -4,21 +4,27 @@ import click
 import re
 import os
 import yaml
-import math
 import sys
+import hashlib
 import traceback
-import tkinter as tk
-from tkinter import filedialog as fd
-from tkinter import ttk
-from tkinter import messagebox
-from tkinter.scrolledtext import ScrolledText
 from pypdf import Transformation, PdfReader, PdfWriter, PageObject
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, NullObject, StreamObject
 from io import BytesIO
 from reportlab.pdfgen import canvas
-from dataclasses import dataclass
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from dataclasses import dataclass, field
 from typing import Any, Union
+from functools import lru_cache
+from collections import OrderedDict
+from itertools import groupby
 from PIL import ImageColor
 
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+
 PDF_INDEX_DIR = os.path.join("data", "pdf_index")
 
 PDFPTS_RATIO = 2.3
@@ -26,6 +32,19 @@ LIST_HEADER_RATIO = 0.1
 LIST_HEADER_FONT_SIZE = 18
 LIST_MARGIN_RATIO = 0.1
 DATASHEET_ANNOT_EXTRA_MARGIN = 0.3
+# pypdf writes the output in many small chunks (object headers, xref entries...)
+OUTPUT_BUFFER_SIZE = 1 << 20
+# an army list usually draws from a handful of PDFs (its book and a few included ones)
+PDF_READER_CACHE_SIZE = 8
+
+# Buffer reused by every annotation batch: merging a page into a PdfWriter page clones its resources
+# and parses its content, so the annotation PDF isn't read anymore once all its pages have been merged.
+ANNOT_PACKET = BytesIO()
+
+# loaded files, by path, with the mtime they were loaded at
+INDEX_NAMES_CACHE: OrderedDict[str, tuple[float | None, Any]] = OrderedDict()
+INDEX_CONTENT_CACHE: OrderedDict[str, tuple[float | None, Any]] = OrderedDict()
+PDF_READER_CACHE: OrderedDict[str, tuple[float | None, Any]] = OrderedDict()
 
 LIST_MODE_NOTHING = "nothing"
 LIST_MODE_JUST_HEADER = "just_header"
@@ -64,31 +83,45 @@ DEFAULT_FEATURES = {
 }
 
 ARMY_SPEC_RE = (
-    r"^(?P<list_header>(?P<list_name>[^\n]+?) \((?P<total_points>[0-9]+) points\)\n"
-    r"(?P<raw_army_rule>[^\n]+?(?:\n[^\n]+?)?)\n"
-    r"(?P<game_format>[^\n]+? \((?P<max_points>[0-9]+) points\))\n"
-    r"(?P<detachment_rule>[^\n]+?))\n"
+    r"^(?P<list_header>(?P<list_name>[^\n]+) \((?P<total_points>[0-9]+) points\)\n"
+    r"(?P<raw_army_rule>[^\n]+(?:\n[^\n]+)?)\n"
+    r"(?P<game_format>[^\n]+ \((?P<max_points>[0-9]+) points\))\n"
+    r"(?P<detachment_rule>[^\n]+))\n"
     r"\n\n"
-    r"(?P<rest>(?:.*\n?)+\Z)"
+    r"(?P<rest>.*)\Z"
 )
 
-UNIT_RE = (
-    r"(?P<unit_name>[^\n]+?) \((?P<unit_points>[0-9]+) points\)\n"
-    r"(?P<wargear>(?:  [^\n]*?(?:\n|\Z))+)"
-)
+UNIT_HEADER_RE = r"^(?P<unit_name>.+?) \((?P<unit_points>[0-9]+) points\)$"
+UNIT_WARGEAR_PREFIX = "  "
+
+_ARMY_SPEC_RE = re.compile(ARMY_SPEC_RE, re.DOTALL)
+_UNIT_HEADER_RE = re.compile(UNIT_HEADER_RE)
+
+@dataclass(slots=True)
+class LazyPdfReader:
+    path: str
+    _reader: PdfReader | None = field(default=None, repr=False)
 
-@dataclass
+    # the PDF is only parsed when one of its pages is needed, so that included indexes
+    # from which no unit is drawn cost nothing
+    @property
+    def reader(self) -> PdfReader:
+        if self._reader is None:
+            self._reader = PdfReader(self.path)
+        return self._reader
+
+@dataclass(frozen=True, slots=True)
 class Unit:
     name: str
     id: str
     points: int
     full_text: str
 
-@dataclass
+@dataclass(slots=True)
 class Rule:
     id: str
     origin: str
-    pdf: PdfReader
+    pdf: LazyPdfReader
     page_range: list[int] | None
 
     def __str__(self):
@@ -97,7 +130,7 @@ class Rule:
     def __repr__(self):
         return self.__str__()
 
-@dataclass
+@dataclass(slots=True)
 class Detachment:
     id: str
     origin: str
@@ -111,11 +144,11 @@ class Detachment:
     def __repr__(self):
         return self.__str__()
 
-@dataclass
+@dataclass(slots=True)
 class Datasheet:
     id: str
     origin: str
-    pdf: PdfReader
+    pdf: LazyPdfReader
     page_range: list[int]
     extra_text: str = ""
     is_armoury: bool = False
@@ -127,31 +160,72 @@ class Datasheet:
         return self.__str__()
 
 
+def indent_unit_lines(lines: list[str]):
+    # the first line of the unit gets a bullet, and the next ones are aligned with it
+    it = iter(lines)
+    yield "  • " + next(it)
+    for l in it:
+        yield "    " + l
+
+
 def fuse_group_into(group: list[Unit], units: list[Unit]) -> None:
     if len(group) == 1:
         units.append(group[0])
         return
     total_points = sum(u.points for u in group)
-    z = lambda l: ["  • " + l[0]] + ["    " + e for e in l[1:]]
-    merged_full_text_lines = "\n".join(
-        [f"{len(group)} u. of {group[0].name} ({total_points} points)\n"] +
-        [l for u in group for l in z(u.full_text.split("\n")) if l]
-    ).strip()
+    # header, then a blank line, then every unit of the group
+    merged_full_text_lines = [f"{len(group)} u. of {group[0].name} ({total_points} points)", ""]
+    for unit in group:
+        merged_full_text_lines.extend(indent_unit_lines(unit.full_text.split("\n")))
     u = Unit(
         name=group[0].name,
         id=group[0].id,
         points=total_points,
-        full_text=merged_full_text_lines
+        full_text="\n".join(merged_full_text_lines)
     )
     units.append(u)
 
 
+def iter_lines_groups(text: str, sep: str, breakpoint_lookahead: str):
+    # Single pass equivalent of splitting text on sep + breakpoint_lookahead (sep being made of newlines only),
+    # dropping blank groups, adding the lookahead back on every group but the first one, and keeping
+    # only the non-blank lines of each group.
+    lines = text.split("\n")
+    nb_lines = len(lines)
+    nb_newlines_in_sep = sep.count("\n")
+    is_first = True
+    start = 0
+    i = 0
+    while i < nb_lines:
+        next_line = i + nb_newlines_in_sep
+        if next_line < nb_lines and lines[next_line].startswith(breakpoint_lookahead) and not any(lines[i + 1:next_line]):
+            # sep + breakpoint_lookahead starts at the end of line i
+            group = lines[start:i + 1]
+        elif i == nb_lines - 1:
+            group = lines[start:]
+            next_line = nb_lines
+        else:
+            i += 1
+            continue
+        # all groups but the one at the start of text begin right after a lookahead
+        first_line_without_lookahead = group[0][len(breakpoint_lookahead):] if start > 0 else group[0]
+        if first_line_without_lookahead.strip() or any(l.strip() for l in group[1:]):
+            if is_first:
+                group[0] = first_line_without_lookahead
+                is_first = False
+            yield [l for l in group if l.strip()]
+        start = i = next_line
+
+
 def arrange_in_two(text: str, lines_count_limit: int, sep: str, breakpoint_lookahead: str) -> tuple[str, str]:
-    str_groups_with_lookahead_removed = [g for g in text.split(sep + breakpoint_lookahead) if g.strip()]
-    str_groups_with_lookahead_added_back = [] if not str_groups_with_lookahead_removed else [str_groups_with_lookahead_removed[0]] + [breakpoint_lookahead + g for g in str_groups_with_lookahead_removed[1:]]
-    lines_groups = [[l for l in g.split("\n") if l.strip()] for g in str_groups_with_lookahead_added_back]  # This removes empty lines inside a group
-    nb_empty_lines_sep_equiv = len(sep.split("\n")) - 2
+    lines_groups = iter_lines_groups(text, sep, breakpoint_lookahead)  # This also removes empty lines inside a group
+    nb_empty_lines_sep_equiv = sep.count("\n") - 1
+
+    if text.count("\n") + 1 <= lines_count_limit:
+        # grouping never produces more lines than the text has, so everything fits in column 1
+        return ("\n" * (nb_empty_lines_sep_equiv + 1)).join("\n".join(g) for g in lines_groups), ""
 
+    sep_lines = [""] * nb_empty_lines_sep_equiv
     lines_column1 = []
     lines_column2 = []
     is_full_column1 = False
@@ -159,31 +233,31 @@ def arrange_in_two(text: str, lines_count_limit: int, sep: str, breakpoint_looka
     lines_count_column2 = 0
 
     for lines_group in lines_groups:
+        group_size = len(lines_group)
         if not is_full_column1:
             if not lines_column1:
                 # first element of column, so doesn't need to be prefixed by sep
-                expected_size = len(lines_group)
                 lines_column1.extend(lines_group)
-                lines_count_column1 += expected_size
+                lines_count_column1 += group_size
             else:
                 # not the first element, so need to be prefixed by sep
-                expected_size = len(lines_group) + nb_empty_lines_sep_equiv
+                expected_size = group_size + nb_empty_lines_sep_equiv
                 if lines_count_column1 + expected_size <= lines_count_limit:
                     # it will fit in column 1
-                    lines_column1.extend([""] * nb_empty_lines_sep_equiv + lines_group)
+                    lines_column1.extend(sep_lines)
+                    lines_column1.extend(lines_group)
                     lines_count_column1 += expected_size
                 else:
                     # if won't fit in column 1, so mark column 1 as complete and go to column 2
                     # now it doesn't need to be prefixed by sep
-                    expected_size = len(lines_group)
                     is_full_column1 = True
                     lines_column2.extend(lines_group)
-                    lines_count_column2 += expected_size
+                    lines_count_column2 += group_size
         else:
             # it isn't the first element of column 2 (so it needs a sep), and we have to put it in column 2 regardless of its size
-            expected_size = len(lines_group) + nb_empty_lines_sep_equiv
-            lines_column2.extend([""] * nb_empty_lines_sep_equiv + lines_group)
-            lines_count_column2 += expected_size
+            lines_column2.extend(sep_lines)
+            lines_column2.extend(lines_group)
+            lines_count_column2 += group_size + nb_empty_lines_sep_equiv
 
     if lines_count_column1 > lines_count_limit:
         # should not happen
@@ -196,53 +270,125 @@ def arrange_in_two(text: str, lines_count_limit: int, sep: str, breakpoint_looka
     return "\n".join(lines_column1), "\n".join(lines_column2)
 
 
-def add_annot(page: PageObject, text_content: str, pos_params: dict[str, float], annot_params: dict[str, Any], sep_can_be_discarded_pb: str, sep_must_be_kept: str, extra_margin: float = DATASHEET_ANNOT_EXTRA_MARGIN) -> None:
-    line_height = annot_params["line_spacing"] * annot_params["font_size"]
-    packet = BytesIO()
-    # create a new PDF with Reportlab
-    canvas_width, canvas_height = pos_params["w"] * PDFPTS_RATIO, pos_params["h"] * PDFPTS_RATIO
-    can = canvas.Canvas(packet, pagesize=(canvas_width, canvas_height))
+def split_in_font_runs(text: str) -> list[tuple[bool, list[str]]]:
+    # lines ending with ")" are unit headers, and are printed in bold
+    runs = []
+    for line in text.split("\n"):
+        line = line.rstrip()
+        is_bold = line.endswith(")")
+        if runs and runs[-1][0] == is_bold:
+            runs[-1][1].append(line)
+        else:
+            runs.append((is_bold, [line]))
+    return runs
+
+
+def draw_text_runs(text_object, text: str, annot_params: dict[str, Any], line_height: float) -> None:
+    # the text object is expected to be set with the regular font; we only switch font between runs
+    current_is_bold = False
+    for is_bold, lines in split_in_font_runs(text):
+        if is_bold != current_is_bold:
+            text_object.setFont(annot_params["font_face"] + ("-Bold" if is_bold else ""), annot_params["font_size"], line_height)
+            current_is_bold = is_bold
+        # passing a list (and not a str) makes reportlab keep the lines untouched
+        text_object.textLines(lines)
+
+
+def draw_column(can: canvas.Canvas, x: float, y: float, text: str, annot_params: dict[str, Any], line_height: float) -> None:
+    text_object = can.beginText(x, y)
+    text_object.setFont(annot_params["font_face"], annot_params["font_size"], line_height)
+    draw_text_runs(text_object, text, annot_params, line_height)
+    can.drawText(text_object)
+
+
+def draw_annot(can: canvas.Canvas, text_content: str, canvas_width: float, canvas_height: float, annot_params: dict[str, Any], sep_can_be_discarded_pb: str, sep_must_be_kept: str, extra_margin: float) -> None:
+    font_size = annot_params["font_size"]
+    line_height = annot_params["line_spacing"] * font_size
+    text_margin_x = extra_margin * font_size
+    text_y = canvas_height - (1 + (max(0, extra_margin - 0.2))) * font_size
     can.setFillColorRGB(*annot_params["color_bg"])
     can.setStrokeColorRGB(*annot_params["color_br"])
     can.rect(0, 0, canvas_width, canvas_height, fill=1)
     can.setFillColorRGB(*annot_params["color_fg"])
-    to = can.beginText(extra_margin * annot_params["font_size"], canvas_height - (1 + (max(0, extra_margin - 0.2))) * annot_params["font_size"])
-    to.setFont(annot_params["font_face"], annot_params["font_size"], line_height)
-    nb_lines_in_one_column = int(math.floor(canvas_height / line_height))
+    # both are positive, so truncating is flooring (unlike //, which can be off by one on float boundaries)
+    nb_lines_in_one_column = int(canvas_height / line_height)
     l1, l2 = arrange_in_two(text_content, nb_lines_in_one_column, sep_can_be_discarded_pb, sep_must_be_kept)
-    for line in l1.split("\n"):
-        line = line.rstrip()
-        if line and line[-1] == ")":
-            to.setFont(annot_params["font_face"] + "-Bold", annot_params["font_size"], line_height)
-            to.textLine(line)
-            to.setFont(annot_params["font_face"], annot_params["font_size"], line_height)
-        else:
-            to.textLine(line)
-    # to.textLines(l1, trim=0)
-    can.drawText(to)
+    draw_column(can, text_margin_x, text_y, l1, annot_params, line_height)
     if l2:
-        can.rect(canvas_width / 2, 0, 0, canvas_height)
-        to2 = can.beginText(canvas_width / 2 + extra_margin * annot_params["font_size"], canvas_height - (1 + (max(0, extra_margin - 0.2))) * annot_params["font_size"])
-        to2.setFont(annot_params["font_face"], annot_params["font_size"])
-        to2.setLeading(line_height)
-        for line in l2.split("\n"):
-            line = line.rstrip()
-            if line and line[-1] == ")":
-                to2.setFont(annot_params["font_face"] + "-Bold", annot_params["font_size"], line_height)
-                to2.textLine(line)
-                to2.setFont(annot_params["font_face"], annot_params["font_size"], line_height)
-            else:
-                to2.textLine(line)
-        # to2.textLines(l2, trim=0)
-        can.drawText(to2)
-    can.save()
-    packet.seek(0)
-    annotation = PdfReader(packet).pages[0]
+        # column divider
+        can.line(canvas_width / 2, 0, canvas_width / 2, canvas_height)
+        draw_column(can, canvas_width / 2 + text_margin_x, text_y, l2, annot_params, line_height)
+
+
+@lru_cache(maxsize=64)
+def get_transformation(scale: float, tx: float, ty: float) -> Transformation:
+    # Transformation objects are immutable, and only a few distinct ones are used (one per annotation region or half page)
+    return Transformation().scale(scale).translate(tx, ty)
+
+
+def apply_annot(page: PageObject, annotation: PageObject, pos_params: dict[str, float]) -> None:
     page.merge_transformed_page(
-            annotation, Transformation().scale(1.0 / PDFPTS_RATIO).translate(pos_params["x"], pos_params["y"]), over=True, expand=False
+            annotation, get_transformation(1.0 / PDFPTS_RATIO, pos_params["x"], pos_params["y"]), over=True, expand=False
         )
 
 
+def draw_annots(annots: list[tuple[str, dict[str, float], dict[str, Any], str, str]], extra_margin: float = DATASHEET_ANNOT_EXTRA_MARGIN) -> list[PageObject]:
+    # all annotations are drawn as the pages of a single Reportlab document, which is then parsed only once
+    if not annots:
+        return []
+    packet = ANNOT_PACKET
+    packet.seek(0)
+    packet.truncate(0)
+    can = canvas.Canvas(packet)
+    # identical annotations (e.g. on each page of a datasheet with its unit composition) are only drawn once
+    annot_indices: dict[tuple, int] = {}
+    page_indices = []
+    for text_content, pos_params, annot_params, sep_can_be_discarded_pb, sep_must_be_kept in annots:
+        key = (text_content, pos_params["w"], pos_params["h"], tuple(annot_params.items()), sep_can_be_discarded_pb, sep_must_be_kept)
+        if key not in annot_indices:
+            annot_indices[key] = len(annot_indices)
+            canvas_width, canvas_height = pos_params["w"] * PDFPTS_RATIO, pos_params["h"] * PDFPTS_RATIO
+            can.setPageSize((canvas_width, canvas_height))
+            draw_annot(can, text_content, canvas_width, canvas_height, annot_params, sep_can_be_discarded_pb, sep_must_be_kept, extra_margin)
+            can.showPage()
+        page_indices.append(annot_indices[key])
+    can.save()
+    packet.seek(0)
+    annot_pages = PdfReader(packet).pages
+    return [annot_pages[i] for i in page_indices]
+
+
+def make_annots_page(width: float, height: float, annots: list[tuple[str, dict[str, float], dict[str, Any], str, str]], extra_margin: float = DATASHEET_ANNOT_EXTRA_MARGIN) -> PageObject:
+    # renders several annotations directly on a new page, with the same result as merging them into a blank page
+    packet = BytesIO()
+    can = canvas.Canvas(packet, pagesize=(width, height))
+    for text_content, pos_params, annot_params, sep_can_be_discarded_pb, sep_must_be_kept in annots:
+        canvas_width, canvas_height = pos_params["w"] * PDFPTS_RATIO, pos_params["h"] * PDFPTS_RATIO
+        can.saveState()
+        can.translate(pos_params["x"], pos_params["y"])
+        can.scale(1.0 / PDFPTS_RATIO, 1.0 / PDFPTS_RATIO)
+        # same clipping as when merging an annotation page
+        clip = can.beginPath()
+        clip.rect(0, 0, canvas_width, canvas_height)
+        can.clipPath(clip, stroke=0, fill=0)
+        draw_annot(can, text_content, canvas_width, canvas_height, annot_params, sep_can_be_discarded_pb, sep_must_be_kept, extra_margin)
+        can.restoreState()
+    can.save()
+    packet.seek(0)
+    return PdfReader(packet).pages[0]
+
+
+def group_rule_pages(rules: list[Rule]) -> list[tuple[LazyPdfReader, list[int]]]:
+    # consecutive rules from the same PDF are appended in one go (as 0-based page indices), keeping the order of rules
+    groups = []
+    for rule in rules:
+        first_page, last_page = rule.page_range
+        if not groups or groups[-1][0] is not rule.pdf:
+            groups.append((rule.pdf, []))
+        groups[-1][1].extend(range(first_page - 1, last_page))
+    return groups
+
+
 def get_army_name(army_index_path: str) -> str:
     _, filename = os.path.split(army_index_path)
     base, _ = os.path.splitext(filename)
@@ -260,14 +406,49 @@ def parse_page_ref(raw: Union[int, list[int]], allow_none=False) -> list[int] |
         raise Exception("Invalid format for page reference")
 
 
-def load_rec_index(army_index_path: str, army_rules: list[Rule], detachments: dict[str, Detachment], armoury_full_pages: list[Rule], armoury_half_pages: list[Datasheet], datasheets: dict[str, Datasheet], status_function, is_main: bool = True) -> None:
+def get_cached_file(cache: OrderedDict[str, tuple[float | None, Any]], path: str, mtime: float | None, load, maxsize: int | None = None) -> Any:
+    # only the latest version of each file is kept, so that an edited file is loaded again without leaving the old one
+    # behind; with maxsize, the least recently used files are dropped too
+    entry = cache.get(path)
+    if entry is None or entry[0] != mtime:
+        entry = cache[path] = (mtime, load(path))
+    cache.move_to_end(path)
+    if maxsize is not None and len(cache) > maxsize:
+        cache.popitem(last=False)
+    return entry[1]
+
+
+def read_index_content(army_index_path: str) -> dict[str, Any]:
+    # the file is given as bytes, which the YAML reader decodes itself (UTF-8 by default)
+    with open(army_index_path, "rb") as army_index_file:
+        return yaml.load(army_index_file, YamlLoader)
+
+
+def load_index_content(army_index_path: str, mtime: float) -> dict[str, Any]:
+    # indexes are small, so all of them are kept
+    return get_cached_file(INDEX_CONTENT_CACHE, army_index_path, mtime, read_index_content)
+
+
+def get_pdf_reader(pdf_path: str) -> LazyPdfReader:
+    # the same PDF can be reached through several includes, and through several generations in the GUI,
+    # so we only parse it once; a missing file is only reported if one of its pages is actually needed
+    # a parsed PDF holds the whole file in memory, so only the last few ones are kept
+    mtime = os.path.getmtime(pdf_path) if os.path.isfile(pdf_path) else None
+    return get_cached_file(PDF_READER_CACHE, os.path.realpath(pdf_path), mtime, LazyPdfReader, PDF_READER_CACHE_SIZE)
+
+
+def load_rec_index(army_index_path: str, army_rules: list[Rule], detachments: dict[str, Detachment], armoury_full_pages: list[Rule], armoury_half_pages: list[Datasheet], datasheets: dict[str, Datasheet], visited: set[tuple[str, bool]], status_function, is_main: bool = True) -> None:
+    # an index can be reached several times through includes (e.g. diamonds), but loading it again would only duplicate its armoury pages
+    visit_key = (os.path.abspath(army_index_path), is_main)
+    if visit_key in visited:
+        return
+    visited.add(visit_key)
     status_function(f"Loading '{army_index_path}'...")
-    with open(army_index_path, "r", encoding="utf-8") as army_index_file:
-        content = yaml.load(army_index_file, yaml.Loader)
-    army_pdf = PdfReader(content["associated_file"])
-    if is_main and "army_rule" in content and content["army_rule"] is not None:
+    content = load_index_content(army_index_path, os.path.getmtime(army_index_path))
+    army_pdf = get_pdf_reader(content["associated_file"])
+    if is_main and content.get("army_rule") is not None:
         army_rules.append(Rule(get_army_name(army_index_path), content["associated_file"], army_pdf, parse_page_ref(content["army_rule"])))
-    if is_main and "detachments" in content and content["detachments"] is not None:
+    if is_main and content.get("detachments") is not None:
         for detachment in content["detachments"]:
             detachments[detachment["name"]] = Detachment(
                 detachment["name"], content["associated_file"],
@@ -275,70 +456,194 @@ def load_rec_index(army_index_path: str, army_rules: list[Rule], detachments: di
                 Rule(detachment["name"] + " stratagems", content["associated_file"], army_pdf, parse_page_ref(detachment["stratagems"])),
                 Rule(detachment["name"] + " enhancements", content["associated_file"], army_pdf, parse_page_ref(detachment["enhancements"], allow_none=True))
             )
-    if "armoury_full_pages" in content and content["armoury_full_pages"] is not None:
+    if content.get("armoury_full_pages") is not None:
         armoury_full_pages.append(Rule("extra rule", content["associated_file"], army_pdf, parse_page_ref(content["armoury_full_pages"])))
-    if "armoury_half_pages" in content and content["armoury_half_pages"] is not None:
+    if content.get("armoury_half_pages") is not None:
         armoury_half_pages.append(Datasheet("armoury", content["associated_file"], army_pdf, parse_page_ref(content["armoury_half_pages"]), "", True))
     for (id, page_range) in content["datasheets"].items():
         datasheets[id] = Datasheet(id, content["associated_file"], army_pdf, parse_page_ref(page_range))
-    if "includes" in content and content["includes"] is not None:
+    if content.get("includes") is not None:
         for include in content["includes"]:
             include_path = os.path.join(PDF_INDEX_DIR, include)
-            load_rec_index(include_path, army_rules, detachments, armoury_full_pages, armoury_half_pages, datasheets, status_function, is_main=True)
-    if "includes_allies" in content and content["includes_allies"] is not None and is_main:
+            load_rec_index(include_path, army_rules, detachments, armoury_full_pages, armoury_half_pages, datasheets, visited, status_function, is_main=True)
+    if content.get("includes_allies") is not None and is_main:
         for include in content["includes_allies"]:
             include_path = os.path.join(PDF_INDEX_DIR, include)
-            load_rec_index(include_path, army_rules, detachments, armoury_full_pages, armoury_half_pages, datasheets, status_function, is_main=False)
+            load_rec_index(include_path, army_rules, detachments, armoury_full_pages, armoury_half_pages, datasheets, visited, status_function, is_main=False)
 
 
+@lru_cache(maxsize=None)
+def register_annot_font(font_face: str) -> None:
+    # standard fonts are already known by Reportlab, other faces (and their bold variant) are loaded as TrueType fonts
+    for face in (font_face, font_face + "-Bold"):
+        try:
+            pdfmetrics.getFont(face)
+        except KeyError:
+            pdfmetrics.registerFont(TTFont(face, face + ".ttf"))
+
+
+@lru_cache(maxsize=64)
 def convert_color(hexstring: str) -> tuple[float, float, float]:
     return tuple(i/256.0 for i in ImageColor.getrgb(hexstring))
 
 
+def iter_units(rest_of_the_list: str):
+    lines = rest_of_the_list.split("\n")
+    i = 0
+    while i < len(lines):
+        match = _UNIT_HEADER_RE.match(lines[i])
+        if match is None:
+            i += 1
+            continue
+        # a unit is a header line followed by at least one wargear line
+        j = i + 1
+        while j < len(lines) and lines[j].startswith(UNIT_WARGEAR_PREFIX):
+            j += 1
+        if j == i + 1:
+            i += 1
+            continue
+        unit_groups = match.groupdict()
+        yield Unit(
+            name=unit_groups["unit_name"],
+            id=unit_groups["unit_name"].strip().upper(),
+            points=int(unit_groups["unit_points"]),
+            full_text="\n".join(lines[i:j]).strip()
+        )
+        i = j
+
+
 def parse_and_group_units(rest_of_the_list: str) -> list[Unit]:
     units = []
-    group = []
-    group_id = None
-    for match in re.finditer(UNIT_RE, rest_of_the_list):
-        # print(match)
-        current = Unit(
-            name=match.group("unit_name"),
-            id=match.group("unit_name").strip().upper(),
-            points=int(match.group("unit_points")),
-            full_text=match.group(0).strip()
-        )
-        if current.id != group_id and group:
-            fuse_group_into(group, units)
-            group = []
-        group.append(current)
-        group_id = current.id
-    if group:
-        fuse_group_into(group, units)
+    # consecutive units with the same datasheet are fused together
+    for _, group in groupby(iter_units(rest_of_the_list), key=lambda u: u.id):
+        fuse_group_into(list(group), units)
     return units
 
+def read_index_names(pdf_index_dir: str) -> frozenset[str]:
+    with os.scandir(pdf_index_dir) as entries:
+        return frozenset(e.name for e in entries if e.name.endswith(".yaml") and e.is_file())
+
+
+def list_index_names() -> frozenset[str]:
+    # the directory is listed again when its mtime changes, so that added or removed indexes are seen
+    return get_cached_file(INDEX_NAMES_CACHE, PDF_INDEX_DIR, os.path.getmtime(PDF_INDEX_DIR), read_index_names)
+
+
 def resolve_army_index_path_from_army_name(try_army_name: str) -> str:
-    pdf_index_names = os.listdir(PDF_INDEX_DIR)
-    if try_army_name + ".yaml" in pdf_index_names:
-        army_index_path = os.path.join(PDF_INDEX_DIR, try_army_name + ".yaml")
-        retry = False
-    elif " -- " in try_army_name:
+    pdf_index_names = list_index_names()
+    if try_army_name + ".yaml" not in pdf_index_names and " -- " in try_army_name:
         new_try = try_army_name.split(" -- ")[0]
         print(f"Warning: I didn't find '{try_army_name}', trying '{new_try}'")
         try_army_name = new_try
-        retry = True
-    else:
+    if try_army_name + ".yaml" not in pdf_index_names:
         raise Exception(f"I didn't find '{try_army_name}', exiting.")
-    if retry:
-        if try_army_name + ".yaml" in pdf_index_names:
-            army_index_path = os.path.join(PDF_INDEX_DIR, try_army_name + ".yaml")
-        else:
-            raise Exception(f"I didn't find '{try_army_name}', exiting.")
-    return army_index_path
+    return os.path.join(PDF_INDEX_DIR, try_army_name + ".yaml")
 
 def get_pos_params(annot_params: dict[str, Any], region: str) -> dict[str, float]:
     return {c: annot_params[region + "_" + c] for c in "xywh"}
 
 
+def get_raw_stream_data(stream: StreamObject) -> bytes:
+    # pyproject pins pypdf to 3.x, whose streams keep their still encoded data in _data; get_data() would decode
+    # (and keep a decoded copy of) every image only to compare them
+    return stream._data
+
+
+def get_object_key(obj) -> Any:
+    # same key for the copies of an object stored several times in a PDF
+    obj = obj.get_object()
+    if isinstance(obj, DictionaryObject):
+        entries = tuple(sorted((k, get_object_key(v)) for k, v in obj.items() if k != "/Length"))
+        if isinstance(obj, StreamObject):
+            return entries, hashlib.md5(get_raw_stream_data(obj), usedforsecurity=False).digest()
+        return entries
+    if isinstance(obj, ArrayObject):
+        return tuple(get_object_key(v) for v in obj)
+    return repr(obj)
+
+
+def share_stream(ref: IndirectObject, streams: dict[Any, IndirectObject], visited: set[int]) -> IndirectObject:
+    # the streams an image points to (soft mask, metadata, ICC profile...) can be copies too, so they are shared first
+    stream = ref.get_object()
+    if id(stream) not in visited:
+        visited.add(id(stream))
+        for key, value in list(stream.items()):
+            if isinstance(value, IndirectObject) and isinstance(value.get_object(), StreamObject):
+                shared_value = share_stream(value, streams, visited)
+                if shared_value != value:
+                    stream[key] = shared_value
+    return streams.setdefault(get_object_key(stream), ref)
+
+
+def share_resources_images(resources, streams: dict[Any, IndirectObject], visited: set[int]) -> None:
+    # pages and forms can share their resources, or point back to them, so each resources dictionary is only seen once
+    resources = resources.get_object() if resources is not None else None
+    if not isinstance(resources, DictionaryObject) or id(resources) in visited:
+        return
+    visited.add(id(resources))
+    xobjects = resources.get("/XObject")
+    xobjects = xobjects.get_object() if xobjects is not None else None
+    if not isinstance(xobjects, DictionaryObject):
+        return
+    for name, ref in list(xobjects.items()):
+        xobject = ref.get_object()
+        if not isinstance(xobject, StreamObject):
+            # broken or null references are left as they are
+            continue
+        if xobject.get("/Subtype") == "/Image" and isinstance(ref, IndirectObject):
+            shared_ref = share_stream(ref, streams, visited)
+            if shared_ref != ref:
+                xobjects[name] = shared_ref
+        elif xobject.get("/Subtype") == "/Form":
+            share_resources_images(xobject.get("/Resources"), streams, visited)
+
+
+def drop_unused_objects(output_pdf: PdfWriter) -> None:
+    # pyproject pins pypdf to 3.x, which writes every object of _objects and can't remove one; the objects nothing
+    # points to anymore are replaced by null objects, which keeps the numbers of the others
+    used_idnums = set()
+    stack = [output_pdf._root, output_pdf._info]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, IndirectObject):
+            if obj.pdf is output_pdf and obj.idnum not in used_idnums:
+                used_idnums.add(obj.idnum)
+                stack.append(obj.get_object())
+        elif isinstance(obj, DictionaryObject):
+            stack.extend(obj.values())
+        elif isinstance(obj, ArrayObject):
+            stack.extend(obj)
+    for i in range(len(output_pdf._objects)):
+        if i + 1 not in used_idnums:
+            output_pdf._objects[i] = NullObject()
+
+
+def share_identical_images(output_pdf: PdfWriter) -> None:
+    # the source books can store the same image several times, and each copy is cloned to the output on its own;
+    # once all pages are placed, they are pointed at a single copy of each image and the other copies are dropped
+    streams: dict[Any, IndirectObject] = {}
+    visited: set[int] = set()
+    for page in output_pdf.pages:
+        share_resources_images(page.get("/Resources"), streams, visited)
+    drop_unused_objects(output_pdf)
+
+
+def get_source_page(source_pages: dict[tuple[int, int], tuple[PageObject, float]], pdf: PdfReader, page_nb: int, target_width: float) -> tuple[PageObject, float]:
+    key = (id(pdf), page_nb)
+    if key not in source_pages:
+        pdf_page = pdf.pages[page_nb - 1]
+        source_pages[key] = (pdf_page, target_width / pdf_page.mediabox.width)
+    return source_pages[key]
+
+
+def merge_half_page(page: PageObject, pdf_page: PageObject, scale: float, y_offset: float) -> None:
+    if abs(scale - 1.0) < 1e-6:
+        # source and output pages have the same width (the usual case), so no need to scale
+        page.merge_translated_page(pdf_page, 0, y_offset, over=True, expand=False)
+    else:
+        page.merge_transformed_page(pdf_page, get_transformation(scale, 0, y_offset), over=True, expand=False)
+
+
 @click.command()
 @click.option("--nogui-input-path", "-i", type=click.Path(exists=True, dir_okay=False, resolve_path=True), default=None)
 @click.option("--output-path", "-o", type=click.Path(dir_okay=False), default=None)
@@ -404,6 +709,13 @@ def derive_output_path(input_path: str | None) -> str:
         return os.path.splitext(input_path)[0] + ".pdf"
 
 def gui(features, annot_params):
+    # tkinter is imported here so that the CLI mode neither loads Tk nor requires it to be installed
+    import tkinter as tk
+    from tkinter import filedialog as fd
+    from tkinter import ttk
+    from tkinter import messagebox
+    from tkinter.scrolledtext import ScrolledText
+
     root = tk.Tk()
     root.title("Datasheet Aggregator")
 
@@ -615,25 +927,31 @@ def gui(features, annot_params):
     root.mainloop()
 
 def convert_list_to_pdf(list_content: str, output_path, features, annot_params, status_function):
-    _annot_params = annot_params.copy()
-    _annot_params["color_fg"] = convert_color(annot_params["color_fg"])
-    _annot_params["color_bg"] = convert_color(annot_params["color_bg"])
-    _annot_params["color_br"] = convert_color(annot_params["color_br"])
-    annot_params = _annot_params
-
-    list_match = re.search(ARMY_SPEC_RE, list_content)
+    annot_params = {
+        **annot_params,
+        "color_fg": convert_color(annot_params["color_fg"]),
+        "color_bg": convert_color(annot_params["color_bg"]),
+        "color_br": convert_color(annot_params["color_br"])
+    }
+    register_annot_font(annot_params["font_face"])
+    top_pos_params = get_pos_params(annot_params, "top")
+    bottom_pos_params = get_pos_params(annot_params, "bottom")
+    header_army_pos_params = get_pos_params(annot_params, "header_army")
+
+    list_match = _ARMY_SPEC_RE.search(list_content)
     if list_match is None:
         raise Exception("Army list doesn't match the expected format.")
     
-    list_header = list_match.group("list_header")
-    list_name = list_match.group("list_name")
-    total_points = int(list_match.group("total_points"))
-    raw_army_name = list_match.group("raw_army_rule")
-    game_format = list_match.group("game_format")
-    max_points = int(list_match.group("max_points"))
-    detachment_rule_name = list_match.group("detachment_rule")
+    list_groups = list_match.groupdict()
+    list_header = list_groups["list_header"]
+    list_name = list_groups["list_name"]
+    total_points = int(list_groups["total_points"])
+    raw_army_name = list_groups["raw_army_rule"]
+    game_format = list_groups["game_format"]
+    max_points = int(list_groups["max_points"])
+    detachment_rule_name = list_groups["detachment_rule"]
     
-    rest_of_the_list = list_match.group("rest")
+    rest_of_the_list = list_groups["rest"]
 
     try_army_name = raw_army_name.replace("\n", " -- ")
     status_function(f"Parsed army header of '{list_name}' ({try_army_name}) with {total_points}/{max_points} points!")
@@ -646,11 +964,13 @@ def convert_list_to_pdf(list_content: str, output_path, features, annot_params,
     armoury_full_pages: list[Rule] = []
     armoury_half_pages: list[Datasheet] = []
     datasheet_dict: dict[str, Datasheet] = {}
-    load_rec_index(main_army_index_path, army_rules, detachments, armoury_full_pages, armoury_half_pages, datasheet_dict, status_function)
+    load_rec_index(main_army_index_path, army_rules, detachments, armoury_full_pages, armoury_half_pages, datasheet_dict, set(), status_function)
 
     # check that we only found 1 army rule
-    if len(army_rules) > 1:
-        raise Exception(f"Several army rules detected: {army_rules}, exiting.")
+    if len(army_rules) != 1:
+        if army_rules:
+            raise Exception(f"Several army rules detected: {army_rules}, exiting.")
+        raise Exception(f"No army rule found for '{try_army_name}', exiting.")
     army_rule = army_rules[0]
     if detachment_rule_name not in detachments:
         raise Exception(f"Requested detachment rule {detachment_rule_name} not found in {detachments}, exiting.")
@@ -658,137 +978,167 @@ def convert_list_to_pdf(list_content: str, output_path, features, annot_params,
     status_function(f"Playing with army rule '{army_rule.id}' and detachment_rule '{detachment.id}'!")
 
     output_pdf = PdfWriter()
-    current_pages = 0
-    ref_box = army_rule.pdf.pages[0].mediabox
+    ref_box = army_rule.pdf.reader.pages[0].mediabox
+    ref_width, ref_height = float(ref_box.width), float(ref_box.height)
 
     # add first page with list recap if needed
     if features["list_mode"] == LIST_MODE_FULL:
         status_function("Adding a first page with the list recap...")
-        output_pdf.add_blank_page(ref_box.width, ref_box.height)
-        current_pages += 1
-        
-        # add list header
-        h = (LIST_HEADER_RATIO * ref_box.height)
-        pos_params = {
-            "x": (LIST_MARGIN_RATIO * ref_box.width),
-            "y": (ref_box.height - LIST_MARGIN_RATIO * ref_box.width - h),
-            "w": ((1 - 2 * LIST_MARGIN_RATIO) * ref_box.width),
+
+        margin = LIST_MARGIN_RATIO * ref_width
+        inner_width = (1 - 2 * LIST_MARGIN_RATIO) * ref_width
+        body_top = (1 - LIST_HEADER_RATIO) * ref_height
+
+        # list header
+        h = (LIST_HEADER_RATIO * ref_height)
+        header_pos_params = {
+            "x": margin,
+            "y": (ref_height - margin - h),
+            "w": inner_width,
             "h": h
         }
-        list_header_annot_params = annot_params.copy()
-        list_header_annot_params["font_size"] = LIST_HEADER_FONT_SIZE
-        add_annot(output_pdf.get_page(current_pages-1), list_header, pos_params, list_header_annot_params, "\n", "")
-
-        # add rest of the list
-        h = ((1 - LIST_HEADER_RATIO) * ref_box.height - 2 * LIST_MARGIN_RATIO * ref_box.width)
-        pos_params = {
-            "x": (LIST_MARGIN_RATIO * ref_box.width),
-            "y": ((1 - LIST_HEADER_RATIO) * ref_box.height - LIST_MARGIN_RATIO * ref_box.width - h),
-            "w": ((1 - 2 * LIST_MARGIN_RATIO) * ref_box.width),
+        list_header_annot_params = {**annot_params, "font_size": LIST_HEADER_FONT_SIZE}
+
+        # rest of the list
+        h = (body_top - 2 * margin)
+        rest_pos_params = {
+            "x": margin,
+            "y": (body_top - margin - h),
+            "w": inner_width,
             "h": h
         }
-        add_annot(output_pdf.get_page(current_pages-1),rest_of_the_list, pos_params, annot_params, "\n\n", "")
+
+        # the recap page only holds text, so it is drawn directly instead of merging annotations into a blank page
+        output_pdf.add_page(make_annots_page(ref_width, ref_height, [
+            (list_header, header_pos_params, list_header_annot_params, "\n", ""),
+            (rest_of_the_list, rest_pos_params, annot_params, "\n\n", "")
+        ]))
+
+    # rule pages are only appended once all of them are known, to append contiguous ones in one go
+    rules_to_print: list[Rule] = []
+
+    def add_rule(rule: Rule, label: str):
+        status_function(f"Adding '{rule.id}' {label} ({rule})...")
+        rules_to_print.append(rule)
 
     # add army rule if needed
     if features["with_army_rule"]:
-        page_range = army_rule.page_range
-        status_function(f"Adding '{army_rule.id}' army rules (pages {page_range} from '{army_rule.origin}')...")
-        output_pdf.append(fileobj=army_rule.pdf, pages=(page_range[0]-1, page_range[1]))
-        current_pages += page_range[1] - (page_range[0]-1)
+        add_rule(army_rule, "army rules")
 
     # add detachment rule if needed
     if features["with_detachment_rule"]:
-        page_range = detachment.rule.page_range
-        status_function(f"Adding '{detachment.rule.id}' detachment rules (pages {page_range} from '{detachment.rule.origin}')...")
-        output_pdf.append(fileobj=detachment.rule.pdf, pages=(page_range[0]-1, page_range[1]))
-        current_pages += page_range[1] - (page_range[0]-1)
+        add_rule(detachment.rule, "detachment rules")
     # add detachment stratagems if needed
     if features["with_detachment_stratagems"]:
-        page_range = detachment.stratagems.page_range
-        status_function(f"Adding '{detachment.stratagems.id}' detachment stratagems (pages {page_range} from '{detachment.stratagems.origin}')...")
-        output_pdf.append(fileobj=detachment.stratagems.pdf, pages=(page_range[0]-1, page_range[1]))
-        current_pages += page_range[1] - (page_range[0]-1)
+        add_rule(detachment.stratagems, "detachment stratagems")
     # add detachment enhancements if needed
-    if features["with_detachment_enhancements"]:
-        page_range = detachment.enhancements.page_range
-        if page_range is not None:
-            status_function(f"Adding '{detachment.enhancements.id}' detachment enhancements (pages {page_range} from '{detachment.enhancements.origin}')...")
-            output_pdf.append(fileobj=detachment.enhancements.pdf, pages=(page_range[0]-1, page_range[1]))
-            current_pages += page_range[1] - (page_range[0]-1)
+    if features["with_detachment_enhancements"] and detachment.enhancements.page_range is not None:
+        add_rule(detachment.enhancements, "detachment enhancements")
 
     datasheets_to_print: list[Datasheet] = []
     # we want to only include extra pages of indexes from which at least one unit is drawn
     # so first we trace which indexes are actually "used"
     used_origins = set()
+    # all units without a datasheet are reported at once
+    missing_unit_ids = []
+    with_unit_comp = features["with_unit_comp"]
     for unit in final_list_units:
-        try:
-            datasheet = datasheet_dict[unit.id]
-        except:
-            raise Exception(f"No datasheet found for '{unit.id}'. Loaded datasheets are {set(id for id in datasheet_dict)}. Exiting")
+        datasheet = datasheet_dict.get(unit.id)
+        if datasheet is None:
+            missing_unit_ids.append(unit.id)
+            continue
         used_origins.add(datasheet.origin)
         datasheet.extra_text = unit.full_text
-        if not features["with_unit_comp"]:
+        if not with_unit_comp:
             # remove unit comp if the option hasn't been set
             datasheet.page_range = [datasheet.page_range[0], datasheet.page_range[0]]
         datasheets_to_print.append(datasheet)
+    if missing_unit_ids:
+        raise Exception(f"No datasheet found for {missing_unit_ids}. Loaded datasheets are {sorted(datasheet_dict)}. Exiting")
 
     # add extra rule pages if needed
     if features["with_armoury"]:
         # now we add only the needed extra pages, starting with full ones:
-        for extra_pages in armoury_full_pages:
-            if extra_pages.origin not in used_origins:
-                continue
-            page_range = extra_pages.page_range
-            status_function(f"Adding extra rule (pages {page_range[0]-page_range[1]} from '{extra_pages.origin}')...")
-            output_pdf.append(fileobj=extra_pages.pdf, pages=(page_range[0]-1, page_range[1]))
-            current_pages += page_range[1] - (page_range[0]-1)
+        armoury_full_pages_to_include = [extra_pages for extra_pages in armoury_full_pages if extra_pages.origin in used_origins]
+        for extra_pages in armoury_full_pages_to_include:
+            status_function(f"Adding extra rule ({extra_pages})...")
+        rules_to_print.extend(armoury_full_pages_to_include)
 
         # now we add the half ones as pseudo-datasheets to be printed before the actual ones
         armoury_half_pages_to_include = [extra_pages for extra_pages in armoury_half_pages if extra_pages.origin in used_origins]
         datasheets_to_print = armoury_half_pages_to_include + datasheets_to_print
 
+    # each append walks the outline and named destinations of its source PDF, so they are kept as few as possible
+    for pdf, page_indices in group_rule_pages(rules_to_print):
+        output_pdf.append(fileobj=pdf.reader, pages=page_indices)
+
     # start bi-modal printing
+    # the placement of every source page is planned first: (page number, whether it goes on the top half,
+    # position of its annotation if it has one)
+    sheet_placements: list[tuple[Datasheet, list[tuple[int, bool, dict[str, float] | None]]]] = []
+    # with unit comp, the bottom half holds the verso of the card, which doesn't get an annotation
+    with_top_annot = features["with_unit_annot"]
+    with_bottom_annot = with_top_annot and not with_unit_comp
+    with_armoury_padding = features["with_armoury_padding"]
     next_is_top = True
     prev_is_armoury = True
     for datasheet in datasheets_to_print:
-        status_function(f"Adding '{datasheet.id}' ({datasheet})...")
         n = datasheet.page_range[1] - datasheet.page_range[0] + 1
         # force current datasheet to start on a new page if the current datasheet will be split over >=2 pages (and isn't armoury page)
         if n > 1 and not datasheet.is_armoury:
             next_is_top = True
         # force current datasheet to start on a new page if prev datasheet was the last armoury page
-        if prev_is_armoury and not datasheet.is_armoury and features["with_armoury_padding"]:
+        if prev_is_armoury and not datasheet.is_armoury and with_armoury_padding:
             next_is_top = True
 
+        placements = []
         for page_nb in range(datasheet.page_range[0], datasheet.page_range[1] + 1):
             if next_is_top:
-                output_pdf.add_blank_page(ref_box.width, ref_box.height)
-                current_pages += 1
-                current_page = output_pdf.get_page(current_pages - 1)
-                pdf_page = datasheet.pdf.pages[page_nb - 1]
-                current_page.merge_transformed_page(pdf_page, Transformation().scale(ref_box.width / pdf_page.mediabox.width).translate(0, ref_box.height // 2), over=True, expand=False)
-                if features["with_unit_annot"] and datasheet.extra_text:
-                    add_annot(current_page, datasheet.extra_text, get_pos_params(annot_params, "top"), annot_params, "\n", "  • ")
-                next_is_top = False
+                pos_params = top_pos_params if with_top_annot and datasheet.extra_text else None
             else:
-                pdf_page = datasheet.pdf.pages[page_nb - 1]
-                current_page.merge_transformed_page(pdf_page, Transformation().scale(ref_box.width / pdf_page.mediabox.width).translate(0, 0), over=True, expand=False)
-                if features["with_unit_annot"] and datasheet.extra_text and not features["with_unit_comp"]:
-                    add_annot(current_page, datasheet.extra_text, get_pos_params(annot_params, "bottom"), annot_params, "\n", "  • ")
-                next_is_top = True
+                pos_params = bottom_pos_params if with_bottom_annot and datasheet.extra_text else None
+            placements.append((page_nb, next_is_top, pos_params))
+            next_is_top = not next_is_top
+        sheet_placements.append((datasheet, placements))
 
         # force next datasheet to start on a new page if the current datasheet has been split on >=2 pages (and isn't armoury page)
         if n > 1 and not datasheet.is_armoury:
             next_is_top = True
         prev_is_armoury = datasheet.is_armoury
 
-    if features["list_mode"] == LIST_MODE_JUST_HEADER:
+    # all annotations are drawn at once, but each one is merged as soon as its half page is placed, as merging
+    # parses the content of the page again, which is smaller before the other half is placed
+    annots_to_draw = [
+        (datasheet.extra_text, pos_params, annot_params, "\n", "  • ")
+        for datasheet, placements in sheet_placements
+        for _, _, pos_params in placements
+        if pos_params is not None
+    ]
+    with_list_header_annot = features["list_mode"] == LIST_MODE_JUST_HEADER
+    if with_list_header_annot:
+        annots_to_draw.append((list_header, header_army_pos_params, annot_params, "\n", ""))
+    annot_pages = iter(draw_annots(annots_to_draw))
+
+    # source pages (and their scale factor) are resolved once, as the same sheet can be printed several times
+    source_pages: dict[tuple[int, int], tuple[PageObject, float]] = {}
+    for datasheet, placements in sheet_placements:
+        status_function(f"Adding '{datasheet.id}' ({datasheet})...")
+        for page_nb, is_top, pos_params in placements:
+            if is_top:
+                current_page = output_pdf.add_blank_page(ref_width, ref_height)
+            pdf_page, scale = get_source_page(source_pages, datasheet.pdf.reader, page_nb, ref_width)
+            merge_half_page(current_page, pdf_page, scale, ref_height // 2 if is_top else 0)
+            if pos_params is not None:
+                apply_annot(current_page, next(annot_pages), pos_params)
+
+    if with_list_header_annot:
         status_function("Adding a header with list info...")
-        add_annot(output_pdf.get_page(0), list_header, get_pos_params(annot_params, "header_army"), annot_params, "\n", "")
+        apply_annot(output_pdf.get_page(0), next(annot_pages), header_army_pos_params)
+    share_identical_images(output_pdf)
 
     # Write PDF and we are done!
     status_function(f"Writing output PDF to '{output_path}'...")
-    with open(output_path, "wb") as output_file:
+    with open(output_path, "wb", buffering=OUTPUT_BUFFER_SIZE) as output_file:
         output_pdf.write(output_file)
     output_pdf.close()
     status_function("Done!")